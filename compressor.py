@@ -1,112 +1,299 @@
-import multiprocessing
+from __future__ import annotations
+
+import io
+import os
 import shutil
-import time
-from multiprocessing.sharedctypes import SynchronizedBase
+import struct
+import traceback
+from multiprocessing.synchronize import Event
 from pathlib import Path
-from queue import Empty
+from types import ModuleType
+from typing import Any, Iterator, Optional
 
-from PIL import Image
+# compared with the lowercased suffix, so that e.g. ".JPG" and ".Jpeg" also match
+_JPEG_SUFFIXES = frozenset({".jpg", ".jpeg"})
 
+# number of freed 16 MiB image memory blocks pillow keeps for the next image,
+# which is about what one file needs (decoded and resized image)
+_BLOCKS_MAX = 4
 
-def increment_with_lock(counter: SynchronizedBase):
-    """increase the counter by 1 with lock"""
-    with counter.get_lock():
-        counter.value += 1  # type: ignore
+# set by init_worker() in each worker of the pool
+_stop_event: Optional[Event] = None
 
+# PIL.Image, pillow is only used by the workers, it is imported by
+# _import_pillow() rather than with this module so that the GUI process starts
+# without it
+_Image: Optional[ModuleType] = None
 
-def clear_tasks(tasks: multiprocessing.Queue, counter: SynchronizedBase):
-    """clear tasks in queue"""
-    try:
-        while tasks.get(timeout=1):
-            increment_with_lock(counter)
-    except Empty:
-        return
 
+def _import_pillow() -> ModuleType:
+    """import PIL.Image once per process"""
+    global _Image
+    if _Image is None:
+        from PIL import Image
 
-def compress_and_save_many(
-    *,
-    counter: SynchronizedBase,
-    tasks: multiprocessing.Queue,
-    max_width: int,
-    override: bool = False,
-):
-    """loop and read tasks from queue and compress and save the images"""
-    try:
-        # wait timeout to avoid blocking
-        while task := tasks.get(timeout=1):
+        _Image = Image
+    return _Image
+
+
+def init_worker(stop_event: Event):
+    """initialize a worker of the pool
+
+    the event is passed to the initializer since it can not be pickled with tasks
+
+    Args:
+        stop_event (Event): remaining tasks are skipped once the event is set
+
+    Refs:
+        https://pillow.readthedocs.io/en/stable/reference/block_allocator.html
+    """
+    global _stop_event
+    _stop_event = stop_event
+    Image = _import_pillow()
+    # reuse the image buffers of the previous file instead of freeing and
+    # allocating (and page faulting) them again, unless set by the user
+    if "PILLOW_BLOCKS_MAX" not in os.environ:
+        Image.core.set_blocks_max(_BLOCKS_MAX)
+
+
+def compress_and_save_tasks(
+    tasks: list[tuple[str, str]], compress_options: dict[str, Any]
+) -> tuple[int, int]:
+    """compress and save a chunk of (input file, output file) tasks, run by the pool
+
+    the remaining tasks are skipped once the stop event of the worker has been set
+
+    a file that fails is copied instead, like the files that can not be
+    compressed, so that it does not cost the other files of the chunk
+
+    Args:
+        tasks (list): (input file, output file) tuples
+        compress_options (dict): keyword arguments of compress_and_save_one(),
+            other than the input and output file, they are sent with each chunk
+            so that the pool is kept when they change
+
+    Returns:
+        (number of tasks in the chunk, number of files that could neither be
+        compressed nor copied), for the progress bar and the status
+    """
+    num_failed = 0
+    for input_file, output_file in tasks:
+        if _stop_event is not None and _stop_event.is_set():
+            break
+        try:
             compress_and_save_one(
-                input_file=task[0],
-                output_file=task[1],
-                max_width=max_width,
-                override=override,
+                input_file=input_file, output_file=output_file, **compress_options
             )
-            increment_with_lock(counter)
-    except Empty:
-        return
+        except Exception:
+            traceback.print_exc()
+            try:
+                shutil.copyfile(input_file, output_file)
+            except OSError:
+                traceback.print_exc()
+                num_failed += 1
+    return len(tasks), num_failed
 
 
 def compress_and_save_one(
     *,
-    input_file: Path,
-    output_file: Path,
+    input_file: str,
+    output_file: str,
     max_width: int,
-    override: bool,
+    optimize: bool = False,
+    quality: int = 95,
+    progressive: bool = False,
+    subsampling: int = -1,
 ) -> None:
     """try to compress jpeg of input_file and save to output_file
 
+    the output file is overwritten if it exists, existing files are skipped when
+    the tasks list is built
+
     the input image will be copied to output file if it can not be compressed, such as:
         - the input file is not jpg
+        - the input file can not be decoded
         - the input file width is less than max_width
         - the output file can not be saved as jpg (e.g. has an alpha channel)
 
     Args:
-        input_file (Path): input file path
-        output_file (Path): output file path
+        input_file (str): input file path
+        output_file (str): output file path, its parent directory must exist
         max_width (int): max width of the output image
-        override (bool, optional): override the output file if it exists.
+        optimize (bool, optional): make an extra pass to compute optimal Huffman
+            tables, the output is a few percent smaller but encodes slower.
+        quality (int, optional): jpeg quality of the output image, from 0 to 95.
+        progressive (bool, optional): save as progressive jpeg, which is usually
+            smaller but encodes slower.
+        subsampling (int, optional): chroma subsampling of the output image, 0 for
+            4:4:4, 1 for 4:2:2, 2 for 4:2:0, -1 for the default of libjpeg (4:2:0).
 
     Refs:
+        https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.resize
         https://pillow.readthedocs.io/en/stable/handbook/concepts.html#concept-filtershttps://pillow.readthedocs.io/en/stable/handbook/concepts.html#concept-filters
         https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#jpeg-saving
     """
-    SUFFIXES: set[str] = {".jpg", ".jpeg", ".JPG", ".JPEG"}
-    if (not override) and output_file.exists():
-        return
-    output_file.parent.mkdir(parents=True, exist_ok=True)
-    if input_file.suffix in SUFFIXES:
-        image = Image.open(input_file)
-        width, height = image.size
-        if width > max_width:
-            resize_ratio = max_width / width
-            width = int(width * resize_ratio)
-            height = int(height * resize_ratio)
-            image = image.resize(size=(int(width), int(height)), resample=Image.LANCZOS)
+    if os.path.splitext(input_file)[1].lower() in _JPEG_SUFFIXES:
+        Image = _import_pillow()
+        jpeg_size = read_jpeg_size(input_file)
+        # narrow jpegs are copied as is, without being opened by pillow
+        if jpeg_size is None or jpeg_size[0] > max_width:
             try:
-                image.save(output_file, "JPEG", optimize=True, quality=95)
-                return
+                with Image.open(input_file) as image:
+                    width, height = image.size
+                    if width > max_width:
+                        # the new width is max_width, int(width * ratio) may be
+                        # one pixel less due to rounding
+                        height = max(height * max_width // width, 1)
+                        width = max_width
+                        # let libjpeg decode at 1/2, 1/4 or 1/8 scale as long as
+                        # the decoded image is not smaller than the target size,
+                        # lanczos does the rest
+                        image.draft(image.mode, (width, height))
+                        if image.size == (width, height):
+                            # the scaled decode is already the target size
+                            resized = image
+                        else:
+                            # for large ratios that remain (e.g. non-jpeg content),
+                            # shrink with the cheap box reduce() first until the
+                            # image is at most 3x the target size, which looks the
+                            # same as pure lanczos
+                            resized = image.resize(
+                                size=(width, height),
+                                resample=Image.LANCZOS,
+                                reducing_gap=3.0,
+                            )
+                        # encode in memory and write the output with a single call,
+                        # instead of one write per block of the encoder, nothing
+                        # is written if the image can not be saved as jpeg
+                        buffer = io.BytesIO()
+                        resized.save(
+                            buffer,
+                            "JPEG",
+                            optimize=optimize,
+                            quality=quality,
+                            progressive=progressive,
+                            subsampling=subsampling,
+                        )
+                        with open(output_file, "wb") as file:
+                            file.write(buffer.getbuffer())
+                        return
             except OSError:
                 pass
-    shutil.copy(input_file, output_file)
+    # copyfile() copies in the kernel (sendfile/fcopyfile) where available and,
+    # unlike copy(), needs no extra chmod to copy the permission bits
+    shutil.copyfile(input_file, output_file)
 
 
-def get_tasks_list(*, input_dir: Path, output_dir: Path) -> list[tuple[Path, Path]]:
-    """get files to be compressed
+def read_jpeg_size(path: str) -> Optional[tuple[int, int]]:
+    """read the size of a jpeg from its SOF header, without decoding it
 
     Args:
-        input_dir (Path): input directory
-        output_dir (Path): output directory
+        path (str): path of the jpeg file
 
     Returns:
-        tasks_list: a list of (input file, output file) tuples
+        (width, height), or None if the file is not a valid jpeg
+
+    Refs:
+        https://www.w3.org/Graphics/JPEG/itu-t81.pdf (Table B.1)
     """
+    with open(path, "rb") as file:
+        if file.read(2) != b"\xff\xd8":
+            return None
+        while True:
+            # a marker is 0xff followed by a code, more 0xff may be used as fill
+            if file.read(1) != b"\xff":
+                return None
+            code = file.read(1)
+            while code == b"\xff":
+                code = file.read(1)
+            if not code or code == b"\xda":
+                # end of file or start of scan, the frame header is missing
+                return None
+            if code == b"\x01" or b"\xd0" <= code <= b"\xd7":
+                # markers without a segment
+                continue
+            segment_length = file.read(2)
+            if len(segment_length) != 2:
+                return None
+            # start of frame markers, except DHT, JPG and DAC
+            if b"\xc0" <= code <= b"\xcf" and code not in b"\xc4\xc8\xcc":
+                frame_header = file.read(5)
+                if len(frame_header) != 5:
+                    return None
+                _, height, width = struct.unpack(">BHH", frame_header)
+                return width, height
+            file.seek(int.from_bytes(segment_length, "big") - 2, os.SEEK_CUR)
+
 
-    def get_output_file(input_file: Path) -> Path:
-        return output_dir / input_file.relative_to(input_dir)
+def scan_files(directory: Path) -> Iterator[tuple[str, os.DirEntry]]:
+    """recursively yield the files in a directory
 
+    os.scandir() caches the file type of each entry, so the walk costs no
+    extra stat() call per file (nor does entry.stat() on Windows)
+
+    like Path.rglob(), nothing is yielded if the directory does not exist, and
+    the directories that can not be read are skipped
+
+    Args:
+        directory (Path): the directory to scan
+
+    Yields:
+        (file path relative to the directory, directory entry of the file)
+    """
+    relative_dirs = [""]
+    while relative_dirs:
+        relative_dir = relative_dirs.pop()
+        try:
+            entries = os.scandir(directory / relative_dir)
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    relative_dirs.append(relative_path)
+                elif entry.is_file():
+                    yield relative_path, entry
+
+
+def get_tasks_list(
+    *, input_dir: Path, output_dir: Path, override: bool = False
+) -> list[tuple[str, str]]:
+    """get files to be compressed and create the output directories
+
+    Args:
+        input_dir (Path): input directory
+        output_dir (Path): output directory
+        override (bool, optional): override the output files that already exist,
+            otherwise the input files are skipped.
+
+    Returns:
+        tasks_list: a list of (input file, output file) tuples, paths are plain
+            strings which are cheaper to pickle and handle than Path objects
+    """
     output_dir.mkdir(parents=True, exist_ok=True)
+    # a set lookup per input file instead of an exists() call per output file
+    existing_files = set()
+    if not override:
+        existing_files = {relative_path for relative_path, _ in scan_files(output_dir)}
 
-    return [
-        (input_file, get_output_file(input_file))
-        for input_file in input_dir.rglob("*.*")
-        if input_file.is_file()
+    sized_files = [
+        (entry.stat().st_size, relative_path)
+        for relative_path, entry in scan_files(input_dir)
+        if "." in entry.name and relative_path not in existing_files
+    ]
+    # largest files first, so that the run does not end with one worker busy on a
+    # big file while the others are idle (longest processing time first)
+    sized_files.sort(key=lambda sized_file: sized_file[0], reverse=True)
+    tasks_list = [
+        (
+            os.path.join(input_dir, relative_path),
+            os.path.join(output_dir, relative_path),
+        )
+        for _, relative_path in sized_files
     ]
+    # create each output directory once, instead of once per file in the workers
+    output_parents = {os.path.dirname(output_file) for _, output_file in tasks_list}
+    for output_parent in output_parents:
+        os.makedirs(output_parent, exist_ok=True)
+    return tasks_list
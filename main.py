@@ -1,11 +1,23 @@
+import functools
 import multiprocessing
+import os
 import sys
-import time
-from multiprocessing import Queue
+import threading
+import traceback
+from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-
-from PyQt5.QtCore import QObject, QThread, pyqtSignal, pyqtSlot
-from PyQt5.QtGui import QCloseEvent, QDragEnterEvent, QDropEvent, QIcon
+from typing import Optional, Sequence
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import (
+    QCloseEvent,
+    QDragEnterEvent,
+    QDropEvent,
+    QIcon,
+    QImage,
+    QImageReader,
+    QPixmap,
+)
 from PyQt5.QtWidgets import (
     QApplication,
     QCheckBox,
@@ -22,6 +34,31 @@ from PyQt5.QtWidgets import (
 
 import compressor
 
+# tasks are sent to the workers in chunks to amortize the pickling and IPC cost of
+# each task, small enough to keep the workers evenly loaded for a few dozen files
+_CHUNKSIZE = 8
+# recycle each worker process after about this many files to bound the memory
+# kept by pillow and libjpeg, a task of the pool is a chunk
+_FILES_PER_CHILD = 512
+# choices of the number of processes, computed once per process instead of once
+# per window, up to the number of CPUs this process may run on (which may be less
+# than the CPUs of the machine, e.g. when started with taskset or in a container)
+if hasattr(os, "sched_getaffinity"):
+    _CPU_COUNT = len(os.sched_getaffinity(0))
+else:
+    _CPU_COUNT = multiprocessing.cpu_count()
+_CPU_CHOICES = tuple(str(n) for n in range(1, _CPU_COUNT + 1))
+# jpeg options of the 自动 quality, by the largest max width they apply to:
+# small images are for previews and web pages where the size matters most, large
+# images keep more detail and horizontal-only chroma subsampling
+_AUTO_QUALITY_OPTIONS = (
+    (1080, {"quality": 78, "subsampling": 2}),  # 4:2:0
+    (sys.maxsize, {"quality": 85, "subsampling": 1}),  # 4:2:2
+)
+# default directories, the home directory is already absolute
+_DEFAULT_INPUT_DIR = os.path.join(Path.home(), "Desktop", "input")
+_DEFAULT_OUTPUT_DIR = os.path.join(Path.home(), "Desktop", "output")
+
 
 class DirLineEdit(QLineEdit):
     def __init__(self, parent=None):
@@ -35,53 +72,62 @@ class DirLineEdit(QLineEdit):
 
     def dropEvent(self, event: QDropEvent):
         for url in event.mimeData().urls():
-            path = Path(url.toLocalFile())
-            if path.is_dir():
-                self.setText(str(path.resolve()))
+            # abspath() is a string operation, whereas resolve() stats every part
+            # of the path, which is slow on network drives
+            path = os.path.abspath(url.toLocalFile())
+            if os.path.isdir(path):
+                self.setText(path)
                 break
 
 
-class Worker(QObject):
-    progress = pyqtSignal(int)
-    finished = pyqtSignal()
+class ScanSignals(QObject):
+    # a QRunnable is not a QObject, so it can not have signals
+    ready = pyqtSignal(list)
+    failed = pyqtSignal(str)
+
+
+class PoolSignals(QObject):
+    # emitted from the result handler thread of the pool with the number of tasks
+    # and of failed files of each finished chunk, and delivered in the GUI thread
+    chunk_done = pyqtSignal(int, int)
+
+    def on_chunk_result(self, result: tuple[int, int]):
+        """callback of a chunk of the pool"""
+        self.chunk_done.emit(*result)  # type: ignore
+
+    def on_chunk_error(self, num_tasks: int, error: BaseException):
+        """error callback of a chunk of the pool, all of its files count as failed
+        so that the run still ends
+        """
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.chunk_done.emit(num_tasks, num_tasks)  # type: ignore
+
+
+class ScanRunnable(QRunnable):
+    def __init__(self, *, input_dir: Path, output_dir: Path):
+        """build the tasks list outside the GUI thread, which may take a while for
+        large directories
 
-    def __init__(
-        self,
-        *,
-        num_processes: int,
-        counter,
-        tasks: Queue,
-        max_width: int,
-        num_tasks: int,
-    ) -> None:
+        Args:
+            input_dir (Path): input directory
+            output_dir (Path): output directory
+        """
         super().__init__()
-        self.num_processes = num_processes
-        self.counter = counter
-        self.tasks = tasks
-        self.max_width = max_width
-        self.num_tasks = num_tasks
+        self.signals = ScanSignals()
+        self.input_dir = input_dir
+        self.output_dir = output_dir
 
     def run(self):
-        # start multi-processes
-        processes = []
-        for _ in range(self.num_processes):
-            p = multiprocessing.Process(
-                target=compressor.compress_and_save_many,
-                kwargs={
-                    "counter": self.counter,
-                    "tasks": self.tasks,
-                    "max_width": self.max_width,
-                },
+        # an exception must not escape run(), pyqt aborts the app if it does
+        try:
+            tasks_list = compressor.get_tasks_list(
+                input_dir=self.input_dir, output_dir=self.output_dir
             )
-            processes.append(p)
-            p.start()
-        while self.counter.value < self.num_tasks:
-            self.progress.emit(self.counter.value)
-            time.sleep(0.1)
-        for p in processes:
-            p.join()
-        self.progress.emit(self.counter.value)
-        self.finished.emit()
+        except Exception as error:
+            traceback.print_exc()
+            self.signals.failed.emit(str(error))  # type: ignore
+            return
+        self.signals.ready.emit(tasks_list)  # type: ignore
 
 
 class MainWindow(QWidget):
@@ -89,21 +135,24 @@ class MainWindow(QWidget):
         """main window of the app"""
         super().__init__()
         # create multi-processes related objects
-        self.tasks = multiprocessing.Queue()
-        self.counter = multiprocessing.Value("i", 0)
-        self.worker_thread = QThread(self)
+        self.stop_event = multiprocessing.Event()
+        self.pool: Optional[Pool] = None
+        self.pool_settings: Optional[tuple] = None
+        self.num_tasks = 0
+        self.num_done = 0
+        self.num_failed = 0
+        self.scanning = False
+        # the pool reports each finished chunk, nothing has to poll its results
+        self.pool_signals = PoolSignals(self)
+        self.pool_signals.chunk_done.connect(self.on_chunk_done)  # type: ignore
 
         # create UI elements
         self.input_dir_label = QLabel("输入文件夹: ")
-        self.input_dir_line_edit = self.create_dir_line_edit(
-            Path.home().joinpath("Desktop", "input")
-        )
+        self.input_dir_line_edit = self.create_dir_line_edit(_DEFAULT_INPUT_DIR)
         self.input_dir_browse_btn = self.create_browse_dir_btn(self.input_dir_line_edit)
 
         self.output_dir_label = QLabel("输出文件夹: ")
-        self.output_dir_line_edit = self.create_dir_line_edit(
-            Path.home().joinpath("Desktop", "output")
-        )
+        self.output_dir_line_edit = self.create_dir_line_edit(_DEFAULT_OUTPUT_DIR)
         self.output_dir_browse_btn = self.create_browse_dir_btn(
             self.output_dir_line_edit
         )
@@ -117,14 +166,28 @@ class MainWindow(QWidget):
         self.ignore_exist_files_label = QLabel("跳过已存在的文件: ")
         self.ignore_exist_files_check_box = self.create_disabled_check_box()
 
+        self.optimize_label = QLabel("优化编码: ")
+        self.optimize_check_box = self.create_check_box(False)
+
+        self.use_threads_label = QLabel("使用多线程: ")
+        self.use_threads_check_box = self.create_check_box(False)
+
+        self.progressive_label = QLabel("渐进式编码: ")
+        self.progressive_check_box = self.create_check_box(False)
+
         self.image_max_width_label = QLabel("图片最大宽度: ")
         self.image_max_width_combo_box = self.create_combo_box(
             ["360", "480", "720", "1080", "2160", "4320"], -2
         )
 
+        self.image_quality_label = QLabel("图片质量: ")
+        self.image_quality_combo_box = self.create_combo_box(
+            ["自动", "75", "80", "85", "90", "95"], -1
+        )
+
         self.num_processes_label = QLabel("进程数: ")
         self.num_processes_combo_box = self.create_combo_box(
-            [str(n) for n in range(1, multiprocessing.cpu_count() + 1)],
+            _CPU_CHOICES,
             -1,
         )
         self.action_btn = self.create_action_button()
@@ -161,10 +224,18 @@ class MainWindow(QWidget):
         grid.addWidget(self.ignore_exist_files_check_box, 2, 3)
         grid.addWidget(self.include_subdir_label, 2, 4)
         grid.addWidget(self.include_subdir_check_box, 2, 5)
+        grid.addWidget(self.optimize_label, 2, 6)
+        grid.addWidget(self.optimize_check_box, 2, 7)
+        grid.addWidget(self.use_threads_label, 2, 8)
+        grid.addWidget(self.use_threads_check_box, 2, 9)
+        grid.addWidget(self.progressive_label, 2, 10)
+        grid.addWidget(self.progressive_check_box, 2, 11)
 
         grid.addWidget(self.action_btn, 3, 11, 2, 1)
         grid.addWidget(self.image_max_width_label, 3, 0)
         grid.addWidget(self.image_max_width_combo_box, 3, 1)
+        grid.addWidget(self.image_quality_label, 3, 2)
+        grid.addWidget(self.image_quality_combo_box, 3, 3)
 
         grid.addWidget(self.num_processes_label, 4, 0)
         grid.addWidget(self.num_processes_combo_box, 4, 1)
@@ -173,6 +244,9 @@ class MainWindow(QWidget):
 
         grid.addWidget(self.status_bar, 6, 0, 1, 12)
         self.setLayout(grid)
+        # compute the size of the window now instead of when it is shown, so that
+        # it is centered with its final size
+        grid.activate()
         self.center_window()
 
     def create_action_button(self) -> QPushButton:
@@ -184,12 +258,12 @@ class MainWindow(QWidget):
         btn.setFixedHeight(64)
         return btn
 
-    def create_dir_line_edit(self, default: Path) -> DirLineEdit:
+    def create_dir_line_edit(self, default: str) -> DirLineEdit:
         """get DirLineEdit() with default attributes"""
         line_edit = DirLineEdit()
         line_edit.setDragEnabled(True)
         line_edit.setReadOnly(True)
-        line_edit.setText(str(default.resolve()))
+        line_edit.setText(default)
         return line_edit
 
     def create_browse_dir_btn(self, edit: QLineEdit) -> QPushButton:
@@ -214,7 +288,17 @@ class MainWindow(QWidget):
         check_box.setEnabled(False)
         return check_box
 
-    def create_combo_box(self, items: list[str], current_index: int) -> QComboBox:
+    def create_check_box(self, checked: bool) -> QCheckBox:
+        """get check box with default attributes
+
+        Args:
+            checked: whether the check box is checked by default
+        """
+        check_box = QCheckBox()
+        check_box.setChecked(checked)
+        return check_box
+
+    def create_combo_box(self, items: Sequence[str], current_index: int) -> QComboBox:
         """get combo box with default attributes
 
         Args:
@@ -250,20 +334,68 @@ class MainWindow(QWidget):
             edit.text(),
         )
         if folder:
-            edit.setText(str(Path(folder).resolve()))
+            edit.setText(os.path.abspath(folder))
+
+    def get_pool(self, num_processes: int, use_threads: bool) -> Pool:
+        """get the pool of workers, which is kept across runs
 
-    @pyqtSlot(int)
-    def on_progress_change(self, progress: int):
-        self.progress_bar.setValue(progress)
+        starting the worker processes (and importing pillow in each of them) is
+        slow, especially with spawn on windows and macos, so the pool is only
+        recreated when one of its settings has changed
 
-    @pyqtSlot()
-    def on_worker_finished(self):
-        self.status_label.setText("正在停止...")
-        self.worker_thread.quit()
-        self.worker_thread.wait()
+        Args:
+            num_processes: number of workers
+            use_threads: use threads instead of processes, pillow releases the GIL
+                while decoding, resizing and encoding, so threads also run in
+                parallel, without starting processes and pickling the tasks
+        """
+        pool_settings = (num_processes, use_threads)
+        if self.pool is not None and pool_settings == self.pool_settings:
+            return self.pool
+        self.close_pool()
+        if use_threads:
+            self.pool = ThreadPool(
+                num_processes,
+                initializer=compressor.init_worker,
+                initargs=(self.stop_event,),
+            )
+        else:
+            self.pool = multiprocessing.Pool(
+                num_processes,
+                initializer=compressor.init_worker,
+                initargs=(self.stop_event,),
+                maxtasksperchild=_FILES_PER_CHILD // _CHUNKSIZE,
+            )
+        self.pool_settings = pool_settings
+        return self.pool
+
+    def close_pool(self):
+        """close the pool of workers if any, it must be idle"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    @pyqtSlot(int, int)
+    def on_chunk_done(self, num_tasks: int, num_failed: int):
+        self.num_done += num_tasks
+        self.num_failed += num_failed
+        if self.num_done >= self.num_tasks:
+            if self.num_failed:
+                self.on_finished(f"已完成, {self.num_failed} 个文件处理失败")
+            else:
+                self.on_finished()
+            return
+        # the bar shows a percentage, so it is only repainted (at most 100 times)
+        # when the percentage changes
+        percent = self.num_done * 100 // self.num_tasks
+        if percent != self.progress_bar.value():
+            self.progress_bar.setValue(percent)
+
+    def on_finished(self, status: str = "已完成"):
         self.progress_bar.setMaximum(1)
         self.progress_bar.reset()
-        self.status_label.setText("已完成")
+        self.status_label.setText(status)
         self.action_btn.setText("开始压缩")
         self.action_btn.setChecked(False)
         self.action_btn.setEnabled(True)
@@ -277,40 +409,78 @@ class MainWindow(QWidget):
             self.stop()
 
     def start(self):
-        # add tasks to the queue
+        # get the tasks list
         self.status_label.setText("正在准备文件列表...")
-        self.action_btn.setEnabled(False)
-        tasks_list = compressor.get_tasks_list(
-            input_dir=Path(self.input_dir_line_edit.text()),
-            output_dir=Path(self.output_dir_line_edit.text()),
+        self.stop_event.clear()
+        scan_runnable = ScanRunnable(
+            input_dir=Path(self.input_dir_line_edit.text()).resolve(),
+            output_dir=Path(self.output_dir_line_edit.text()).resolve(),
         )
-        for task in tasks_list:
-            self.tasks.put(task)
+        scan_runnable.signals.ready.connect(self.on_tasks_list_ready)  # type: ignore
+        scan_runnable.signals.failed.connect(self.on_scan_failed)  # type: ignore
+        self.scanning = True
+        QThreadPool.globalInstance().start(scan_runnable)
+
+    @pyqtSlot(str)
+    def on_scan_failed(self, message: str):
+        self.scanning = False
+        self.on_finished(f"无法准备文件列表: {message}")
+
+    @pyqtSlot(list)
+    def on_tasks_list_ready(self, tasks_list: list[tuple[str, str]]):
+        self.scanning = False
         # reset progress bar
         self.progress_bar.reset()
-        self.progress_bar.setMaximum(len(tasks_list))
+        self.progress_bar.setRange(0, 100)
         self.progress_bar.setHidden(False)
+        self.num_tasks = len(tasks_list)
+        self.num_done = 0
+        self.num_failed = 0
+        # no worker has to be started if there is nothing to do, or if stopped
+        # while the list was being prepared
+        if not tasks_list or self.stop_event.is_set():
+            self.on_finished()
+            return
         # start worker
-        self.worker_object = Worker(
+        max_width = int(self.image_max_width_combo_box.currentText())
+        quality = self.image_quality_combo_box.currentText()
+        if quality == "自动":
+            quality_options = next(
+                options
+                for options_max_width, options in _AUTO_QUALITY_OPTIONS
+                if max_width <= options_max_width
+            )
+        else:
+            quality_options = {"quality": int(quality)}
+        compress_options = {
+            "max_width": max_width,
+            "optimize": self.optimize_check_box.isChecked(),
+            "progressive": self.progressive_check_box.isChecked(),
+            **quality_options,
+        }
+        pool = self.get_pool(
             num_processes=int(self.num_processes_combo_box.currentText()),
-            tasks=self.tasks,
-            max_width=int(self.image_max_width_combo_box.currentText()),
-            counter=self.counter,
-            num_tasks=len(tasks_list),
+            use_threads=self.use_threads_check_box.isChecked(),
         )
-        self.worker_object.moveToThread(self.worker_thread)
-        self.worker_thread.started.connect(self.worker_object.run)
-        self.worker_object.progress.connect(self.on_progress_change)  # type: ignore
-        self.worker_object.finished.connect(self.on_worker_finished)  # type: ignore
-        self.worker_thread.start()
-        self.action_btn.setEnabled(True)
+        # the callbacks run in the result handler thread of the pool as soon as a
+        # chunk is done
+        for i in range(0, len(tasks_list), _CHUNKSIZE):
+            chunk = tasks_list[i : i + _CHUNKSIZE]
+            pool.apply_async(
+                compressor.compress_and_save_tasks,
+                (chunk, compress_options),
+                callback=self.pool_signals.on_chunk_result,
+                error_callback=functools.partial(
+                    self.pool_signals.on_chunk_error, len(chunk)
+                ),
+            )
         self.status_label.setText("正在压缩...")
 
     def stop(self):
         self.status_label.setText("正在取消任务...")
         self.action_btn.setEnabled(False)
         self.progress_bar.setHidden(False)
-        compressor.clear_tasks(self.tasks, self.counter)
+        self.stop_event.set()
 
     def closeEvent(self, event: QCloseEvent):
         """override close event
@@ -318,13 +488,27 @@ class MainWindow(QWidget):
         Args:
             event: close event
         """
-        if hasattr(self, "worker_thread") and self.worker_thread.isRunning():
+        if self.scanning or self.num_done < self.num_tasks:
             self.stop()
             event.ignore()
         else:
+            self.close_pool()
             event.accept()
 
 
+def load_icon_images(icon_file: str, images: list[QImage]):
+    """read and decode every size of the icon file into images
+
+    QImage, unlike QPixmap and QIcon, can be used outside the GUI thread
+    """
+    reader = QImageReader(icon_file)
+    for _ in range(reader.imageCount()):
+        image = reader.read()
+        if not image.isNull():
+            images.append(image)
+        reader.jumpToNextImage()
+
+
 def app():
     """start the application"""
     # workaround for windows taskbar icon
@@ -332,20 +516,36 @@ def app():
     if sys.platform == "win32":
         import ctypes
 
-        ctypes.windll.shell32.SetCurrentProcessExplicitAppUserModelID("jepg-compressor")
+        # a typed function of a private WinDLL, instead of the untyped lookup
+        # through the shared ctypes.windll
+        shell32 = ctypes.WinDLL("shell32", use_last_error=True)
+        set_app_id = shell32.SetCurrentProcessExplicitAppUserModelID
+        set_app_id.argtypes = [ctypes.c_wchar_p]
+        set_app_id.restype = ctypes.c_long
+        set_app_id("jepg-compressor")
     # windows GUI fix
     multiprocessing.freeze_support()
     # get icon file path (to be compatible with nuitka)
     icon_file: str = str((Path(__file__).parent / "resources" / "icon.ico").resolve())
 
     app = QApplication(sys.argv)
+    # load the icon while the window is being created and painted
+    icon_images: list[QImage] = []
+    icon_thread = threading.Thread(
+        target=load_icon_images, args=(icon_file, icon_images), daemon=True
+    )
+    icon_thread.start()
     app.setStyle("Fusion")
-    app.setWindowIcon(QIcon(icon_file))
 
     window = MainWindow()
-    window.setWindowIcon(QIcon(icon_file))
     window.setWindowTitle("图片批量压缩工具")
     window.show()
+    icon_thread.join()
+    icon = QIcon()
+    for image in icon_images:
+        icon.addPixmap(QPixmap.fromImage(image))
+    # the window uses the icon of the application
+    app.setWindowIcon(icon)
     sys.exit(app.exec())
 
 